@@ -0,0 +1,75 @@
+import networkx
+import numpy
+import pytest
+
+import versatility
+
+
+def test_leiden_partitions_vary():
+    pytest.importorskip("leidenalg")
+    g = networkx.Graph(networkx.karate_club_graph())
+    parts = {tuple(sorted(versatility.find_communities_leiden(g, gamma=1).items())) for _ in range(20)}
+    assert len(parts) > 1
+    vers = versatility.find_nodal_versatility(g, versatility.find_communities_leiden, it=20)
+    assert any(v > 0 for v in vers.values())
+
+
+def test_louvain_gpu_partitions_vary():
+    pytest.importorskip("cugraph")
+    g = networkx.Graph(networkx.karate_club_graph())
+    parts = {tuple(sorted(versatility.find_communities_louvain_gpu(g, gamma=1).items())) for _ in range(20)}
+    assert len(parts) > 1
+    vers = versatility.find_nodal_versatility(g, versatility.find_communities_louvain_gpu, it=20)
+    assert any(v > 0 for v in vers.values())
+
+
+@pytest.mark.parametrize("label", [lambda c: frozenset([c, c+1]),
+                                   lambda c: (c, "community"),
+                                   lambda c: None if c == 0 else str(c)])
+def test_consensus_matrix_label_types(label):
+    g = networkx.Graph(networkx.karate_club_graph())
+    parts = [{n : (n + i) % 3 for n in g.nodes()} for i in range(4)]
+    runs = iter(parts)
+    def alg(g):
+        return {n : label(c) for n,c in next(runs).items()}
+    C = versatility.consensus_matrix(g, alg, it=4)
+    expected = sum(numpy.array([[p[j] == p[k] for k in g.nodes()] for j in g.nodes()]) for p in parts)/4
+    assert numpy.array_equal(C, expected)
+
+
+def _random_partition(g):
+    return {n : numpy.random.randint(3) for n in g.nodes()}
+
+
+def test_workers_use_different_random_states():
+    # Simulate two forked worker processes, which both start with the
+    # parent's random state.
+    g = networkx.Graph(networkx.karate_club_graph())
+    labels = []
+    for _ in range(2):
+        numpy.random.seed(0)
+        versatility._init_worker(g)
+        labels.append(versatility._community_labels_for_it(5, _random_partition))
+    assert not numpy.array_equal(labels[0], labels[1])
+
+
+@pytest.mark.parametrize("processors", [1, 2])
+def test_mean_versatility_only_sets_its_attributes(processors):
+    g = networkx.Graph(networkx.karate_club_graph())
+    before = {n : set(d) for n,d in g.nodes(data=True)}
+    versatility.find_nodal_mean_versatility(g, versatility.find_communities_louvain, processors=processors,
+                                            argvals=[0.8, 1.2], it=5)
+    for n,d in g.nodes(data=True):
+        assert set(d) == before[n] | {"meanvers", "meanversvals"}
+
+
+def test_gamma_curve_precomputes_only_when_serial(monkeypatch):
+    g = networkx.Graph(networkx.karate_club_graph())
+    passed = []
+    def consensus_matrix_par(g, alg, algargs={}, **kwargs):
+        passed.append(algargs)
+        return versatility.consensus_matrix(g, alg, algargs=algargs, it=kwargs["it"])
+    monkeypatch.setattr(versatility, "consensus_matrix_par", consensus_matrix_par)
+    versatility.find_optimal_gamma_curve(g, versatility.find_communities_louvain, argvals=[1.0], it=5,
+                                         show=False, processors=2)
+    assert passed and all("adj" not in a for a in passed)
@@ -24,6 +24,8 @@
 #   https://github.com/aestrivex/bctpy or "pip install bcpty".  If you
 #   don't want to install bctpy, it should be pretty easy to modify
 #   this code to remove the dependency.
+# - leidenalg (optional): Only needed for find_communities_leiden.
+# - cugraph (optional): Only needed for find_communities_louvain_gpu.
 
 # Here is a quick example to get you started:
 #
@@ -47,6 +49,7 @@ import bct
 import networkx
 import matplotlib.pyplot as plt
 import numpy
+import scipy.sparse
 import scipy.stats
 
 # ▌ ▌            ▐  ▗▜ ▗▐             ▐     ▗       
@@ -102,16 +105,52 @@ def find_nodal_versatility(g, alg, algname="", processors=1, algargs={}, it=200)
     else:
         C = consensus_matrix_par(g, alg, it=it, processors=processors, algargs=algargs)
     g.graph['%sconsmatrix' % algname] = C.astype('float16')
-    Cs = numpy.sin(numpy.pi*C)
-    assert numpy.all(C == C.T) and numpy.all(Cs == Cs.T), "Assocation matrix or versatility matrix not symmetric"
-    assert type(C) == numpy.ndarray and type(Cs) == numpy.ndarray, "Not ndarrays" # Not numpy.matrix 
-    versatility = numpy.sum(Cs, axis=0)/numpy.sum(C, axis=0)
-    versatility[versatility<1e-10] = 0 # Prevent really small values
-    versatilitydict = {list(g.nodes())[i] : versatility[i] for i in range(0, len(g.nodes()))}
+    versatility = _versatility(C)
+    versatilitydict = dict(zip(g.nodes(), versatility.tolist()))
     networkx.set_node_attributes(g, name="%svers" % algname, values=versatilitydict)
     g.graph["%svers" % algname] = numpy.mean(versatility)
     return versatilitydict
 
+def _versatility(C):
+    """Compute nodal versatility from the association matrix `C`.
+
+    This returns an array of the versatility of each node, in the same
+    order as the rows of `C`.  See find_nodal_versatility for details.
+    """
+    Cs = _sin_pi(C)
+    # Cs is symmetric whenever C is, since it is computed elementwise.
+    assert numpy.all(C == C.T), "Assocation matrix not symmetric"
+    assert type(C) == numpy.ndarray and type(Cs) == numpy.ndarray, "Not ndarrays" # Not numpy.matrix 
+    # Since the matrices are symmetric, column sums are the same as row
+    # sums, which read the (row-major) arrays contiguously.
+    versatility = numpy.sum(Cs, axis=1)/numpy.sum(C, axis=1)
+    versatility[versatility<1e-10] = 0 # Prevent really small values
+    return versatility
+
+# Since sin(πx) is zero at x=0 and x=1 and symmetric about x=1/2, on
+# [0,1] it is x(1-x) times a smooth function of (x-1/2)².  A degree 6
+# polynomial fit to this function is accurate to about 1e-14.
+_x = numpy.linspace(0, 1, 10001)[1:-1]
+_sin_pi_coefs = numpy.polynomial.polynomial.polyfit((_x-.5)**2, numpy.sin(numpy.pi*_x)/(_x*(1-_x)), 6)
+del _x
+
+def _sin_pi(C):
+    """Compute sin(πC) for an array `C` with values in [0,1].
+
+    This evaluates the polynomial approximation above, which is
+    faster than numpy.sin and exactly zero when C is 0 or 1.
+    """
+    T = numpy.subtract(C, .5)
+    numpy.square(T, out=T)
+    Cs = numpy.full_like(T, _sin_pi_coefs[-1])
+    for a in _sin_pi_coefs[-2::-1]:
+        Cs *= T
+        Cs += a
+    numpy.subtract(1, C, out=T)
+    T *= C
+    Cs *= T
+    return Cs
+
 
 _argvalsm = numpy.array(range(4, 25), dtype=float)/10
 def find_nodal_mean_versatility(g, alg, algname="", processors=1, argname="gamma", argvals=_argvalsm, it=100):
@@ -128,18 +167,59 @@ def find_nodal_mean_versatility(g, alg, algname="", processors=1, argname="gamma
     these values as a dictionary indexed by node.  Furthermore, it
     computes the mean of these mean versatility values and assigns it
     as a graph property named "[algname]meanvers".
+
+    If `processors` is greater than 1, the values in `argvals` will
+    be divided among the processors, rather than dividing the
+    iterations for each value.
     """
-    gc = g.copy()
-    for v in argvals:
-        find_nodal_versatility(gc, alg, algname=str(v), processors=processors, algargs={argname : v}, it=it)
-        print(v)
-    means = { n : numpy.mean([gc.node[n][str(v)+"vers"] for v in argvals]) for n in gc.nodes() }
-    allvals = { n : dict(zip(argvals, [gc.node[n][str(v)+"vers"] for v in argvals])) for n in gc.nodes() }
+    import multiprocessing, functools
+    assert type(processors) == int and processors > 0, "Invalid number of processors"
+    # Each parameter value is independent of the others, so when we
+    # have multiple processors we parallelize across parameter values
+    # rather than dividing up the iterations for each value.  This
+    # way we only need to start a single pool of processes.
+    #
+    # V is the versatility indexed by [parameter value, node].
+    nodes = list(g.nodes())
+    V = numpy.empty((len(argvals), len(nodes)))
+    if processors == 1:
+        # The algorithm may set node attributes on the graph on each
+        # run (e.g. "louvain"), so save them and put them back after,
+        # leaving only the attributes we assign below.  This is much
+        # cheaper than copying the entire graph.
+        nodeattrs = {n : dict(d) for n,d in g.nodes(data=True)}
+        algargs = _precompute_algargs(g, alg)
+        for i,v in enumerate(argvals):
+            V[i] = _versatility(consensus_matrix(g, alg, it=it, algargs=dict(algargs, **{argname : v})))
+            print(v)
+        for n,d in g.nodes(data=True):
+            d.clear()
+            d.update(nodeattrs[n])
+    else:
+        try:
+            p = multiprocessing.Pool(processors, initializer=_init_worker, initargs=(g, alg))
+            f = functools.partial(_versatility_for_arg, alg=alg, argname=argname, it=it)
+            for i,(v,vs) in enumerate(zip(argvals, p.imap(f, argvals))):
+                V[i] = vs
+                print(v)
+        finally:
+            p.terminate()
+    means = dict(zip(nodes, numpy.mean(V, axis=0)))
+    allvals = { n : dict(zip(argvals, V[:,i])) for i,n in enumerate(nodes) }
     networkx.set_node_attributes(g, name="%smeanvers" % algname, values=means)
     networkx.set_node_attributes(g, name="%smeanversvals" % algname, values=allvals)
     g.graph["%smeanvers" % algname] = numpy.mean(list(means.values()))
     return means
 
+def _versatility_for_arg(v, alg, argname="gamma", it=100):
+    """Find the versatility of each node with `argname` set to `v`.
+
+    This is a helper for find_nodal_mean_versatility to run in a
+    worker process, on the graph given to `_init_worker`.
+    """
+    algargs = dict(_worker_algargs, **{argname : v})
+    return _versatility(consensus_matrix(_worker_graph, alg, it=it, algargs=algargs))
+
 _argvalsc = numpy.asarray(list(range(0, 40)))/10+.1
 def find_optimal_gamma_curve(G, alg, algarg="gamma", argvals=_argvalsc, it=100, show=True, **kwargs):
     """Plots the mean network versatility across a spectrum of resolution parameters.
@@ -156,15 +236,20 @@ def find_optimal_gamma_curve(G, alg, algarg="gamma", argvals=_argvalsc, it=100,
     import scipy.stats
     import sys
     gs = argvals
-    vs = []
-    sems = []
-    for g in gs:
-        v = find_nodal_versatility(G, alg=alg, algargs={algarg : g}, it=it, **kwargs)
-        vs.append(numpy.mean(list(v.values())))
-        sems.append(scipy.stats.sem(list(v.values())))
+    # Versatility indexed by [parameter value, node]
+    nodes = list(G.nodes())
+    V = numpy.empty((len(gs), len(nodes)))
+    # With multiple processors, leave it to the worker processes to
+    # precompute arguments, rather than sending them to each process.
+    algargs = _precompute_algargs(G, alg) if kwargs.get("processors", 1) == 1 else {}
+    for i,g in enumerate(gs):
+        v = find_nodal_versatility(G, alg=alg, algargs=dict(algargs, **{algarg : g}), it=it, **kwargs)
+        V[i] = [v[n] for n in nodes]
         print(g, end=" ")
         sys.stdout.flush()
     print("\n")
+    vs = list(numpy.mean(V, axis=1))
+    sems = list(scipy.stats.sem(V, axis=1))
     if show == True:
         plt.errorbar(gs, vs, yerr=sems)
         plt.title("Versatility across different values of %s" % algarg)
@@ -186,26 +271,67 @@ def consensus_matrix(g, algorithm, it=500, algargs={}):
     `g` should be a networkx graph with N nodes.  `algorithm` should
     be a function that takes a networkx graph as its input and gives a
     dictionary as its output, where the index is the node and the
-    value is an identifier representing the community.  This function
-    runs `algorithm` `it` times (where `it` ∈ ℕ^+) and returns a NxN
-    array, where the (i,j)-th cell is the probability that node i is
-    in the same community as node j.  The rows and columns of the
-    matrix are sorted by the list g.nodes().  Optionally, `algargs` is
-    a list of arguments to pass to the modularity algorithm.
+    value is a (hashable) identifier representing the community.  This
+    function runs `algorithm` `it` times (where `it` ∈ ℕ^+) and
+    returns a NxN array, where the (i,j)-th cell is the probability
+    that node i is in the same community as node j.  The rows and
+    columns of the matrix are sorted by the list g.nodes().
+    Optionally, `algargs` is a list of arguments to pass to the
+    modularity algorithm.
     """
     assert type(g) == networkx.classes.graph.Graph, "Not a graph"
     assert callable(algorithm), "f is not a function"
     assert type(it) == int, "Non-integer iterations"
     assert it > 0, "It needs to be greater than 0"
-    consensus = numpy.zeros((len(g), len(g)))
+    return _consensus_from_labels(_community_labels(g, algorithm, it=it, algargs=algargs))
+
+def _community_labels(g, algorithm, it=500, algargs={}):
+    """Run a community detection algorithm repeatedly on a graph.
+
+    `g`, `algorithm`, `it`, and `algargs` are as in consensus_matrix.
+    This returns an `it`xN integer array, where each row gives the
+    community of each node (sorted by g.nodes()) in one run of the
+    algorithm, with communities numbered from 0.
+    """
+    # Information about the graph which the algorithm can reuse (e.g.
+    # the adjacency matrix) doesn't change between iterations, so find
+    # it once here rather than on every iteration.
+    algargs = _precompute_algargs(g, algorithm, algargs)
+    nodes = list(g.nodes())
+    nodeset = frozenset(nodes)
+    N = len(nodes)
+    labels = numpy.empty((it, N), dtype=int)
     for i in range(0, it):
         p = algorithm(g, **algargs)
         assert type(p) == dict, "Wrong algorithm return type"
-        assert len(p) == len(g), "Wrong algorithm return length"
-        assert set(list(p.keys())) == set(g.nodes()), "Keys not nodes"
-        consensus += numpy.array([[p[k] == p[j] for k in g.nodes()] for j in g.nodes()])
-    consensus /= it
-    return consensus
+        assert len(p) == N, "Wrong algorithm return length"
+        assert p.keys() == nodeset, "Keys not nodes"
+        # Number the communities in order of first appearance.  This
+        # only needs the identifiers to be hashable, not orderable.
+        ids = {}
+        labels[i] = [ids.setdefault(p[n], len(ids)) for n in nodes]
+    return labels
+
+def _consensus_from_labels(labels):
+    """Build a consensus matrix from community labels.
+
+    `labels` should be an array as returned by _community_labels.
+    Two nodes are in the same community iff their rows of the one-hot
+    community indicator matrix Y overlap, so Y·Yᵀ counts how often
+    they were grouped together.  We put the indicator matrices of all
+    runs side by side, which gives the consensus matrix from a single
+    sparse matrix product.
+    """
+    it,N = labels.shape
+    ncomms = labels.max(axis=1) + 1
+    offsets = numpy.cumsum(ncomms) - ncomms
+    cols = (labels + offsets[:,None]).ravel()
+    rows = numpy.tile(numpy.arange(N), it)
+    # Each count is at most `it`, so count in the smallest integer type
+    # which can hold `it` and only convert to floats at the end.
+    ones = numpy.ones(it*N, dtype=numpy.min_scalar_type(it))
+    Y = scipy.sparse.csr_matrix((ones, (rows, cols)), shape=(N, numpy.sum(ncomms)))
+    return (Y @ Y.T).toarray()/it
 
 def consensus_matrix_par(g, algorithm, it=500, processors=2, algargs={}):
     """The consensus_matrix function parallelized.
@@ -223,22 +349,59 @@ def consensus_matrix_par(g, algorithm, it=500, processors=2, algargs={}):
     # The idea here is that, since a consensus matrix is just a bunch
     # of matrices averaged together, we do "`it` divided by
     # `processors`" iterations on each processor and then average
-    # together the results.  It sometimes does slightly more
-    # iterations if it doesn't divide perfectly.
+    # together the results.  If it doesn't divide perfectly, some
+    # processors do one more iteration than the others.
     # 
-    # To do this, we make `processors` copies of the graph, and then
-    # use a parallel pool map to send it to `processors` processors.
-    itadj = int(numpy.ceil(it/processors))
-    gs = [g for i in range(0, processors)] # This doesn't actually use any more memory since g is a reference
+    # To do this, we use a parallel pool map to run the algorithm on
+    # `processors` processors.  The graph is handed to each process
+    # once when the pool starts (for free if processes are forked)
+    # instead of being pickled with every task.  Each process sends
+    # back only the community labels from its runs, which are much
+    # smaller than an NxN matrix, and we build the consensus matrix
+    # from all of them here.
+    its = [it//processors + (i < it % processors) for i in range(0, processors)]
+    its = [i for i in its if i > 0]
     # Use try-except catch-all to make sure we close the processes.
     # That way when we ctrl+c, we don't have 20 python processes
     # permanently running on our computer.
     try:
-        p = multiprocessing.Pool(processors)
-        cs = p.map(functools.partial(consensus_matrix, algorithm=algorithm, it=itadj, algargs=algargs), gs)
+        p = multiprocessing.Pool(processors, initializer=_init_worker, initargs=(g,))
+        f = functools.partial(_community_labels_for_it, algorithm=algorithm, algargs=algargs)
+        # Fill in the labels as each process finishes, rather than
+        # collecting them all and then copying them into one array.
+        labels = numpy.empty((it, len(g)), dtype=int)
+        i = 0
+        for ls in p.imap_unordered(f, its):
+            labels[i:i+len(ls)] = ls
+            i += len(ls)
     finally:
         p.terminate()
-    return numpy.mean(cs, axis=0)
+    return _consensus_from_labels(labels)
+
+# The graph used by worker processes in a multiprocessing pool, and
+# the precomputed arguments for the algorithm run on it, set by
+# _init_worker when each process starts.
+_worker_graph = None
+_worker_algargs = {}
+
+def _init_worker(g, alg=None):
+    """Initialize a worker process to operate on the graph `g`.
+
+    This also reseeds numpy's random number generator from the
+    operating system.  If `alg` is given, arguments for it which can
+    be reused across runs on `g` (see _precompute_algargs) are found
+    once here, so that each task in this process can reuse them.
+    """
+    global _worker_graph, _worker_algargs
+    # Forked processes inherit the parent's random state, so without
+    # reseeding every process would give exactly the same partitions.
+    numpy.random.seed()
+    _worker_graph = g
+    _worker_algargs = _precompute_algargs(g, alg)
+
+def _community_labels_for_it(it, algorithm, algargs={}):
+    """Run _community_labels on the worker's graph for `it` iterations."""
+    return _community_labels(_worker_graph, algorithm, it=it, algargs=algargs)
 
 
 # ▞▀▖                 ▗▐         ▜          ▗▐  ▌         
@@ -247,7 +410,7 @@ def consensus_matrix_par(g, algorithm, it=500, processors=2, algargs={}):
 # ▝▀ ▝▀ ▘▝ ▘▘▝ ▘▝▀▘▘ ▘▀▘▀ ▗▄▘ ▝▀▘ ▘▗▄▘▝▀ ▘  ▀▘▀ ▘ ▘▘▝ ▘▀▀ 
 
 
-def find_communities_louvain(g, gamma=1):
+def find_communities_louvain(g, gamma=1, adj=None):
     """The louvain algorithm for community (module) structure.
 
     The input should be a graph in networkx graph format.  This
@@ -256,10 +419,125 @@ def find_communities_louvain(g, gamma=1):
     returns a dictionary, where each index is a node and the value is
     the value is an integer representing the community index that node
     is a part of.
+
+    Optionally, `adj` may be the adjacency matrix of `g` as a numpy
+    array, with rows and columns sorted by g.nodes().  This saves
+    recomputing it when the algorithm is run many times on the same
+    graph.  (consensus_matrix does this automatically.)
     """
     assert type(g) == networkx.classes.graph.Graph, "Not a graph"
     #assert networkx.is_connected(g), "Graph not connected"
-    lmodule = bct.community_louvain(numpy.asarray(networkx.to_numpy_matrix(g)), gamma=gamma)
+    if adj is None:
+        adj = networkx.to_numpy_array(g)
+    assert adj.shape == (len(g), len(g)), "Invalid adjacency matrix"
+    lmodule = bct.community_louvain(adj, gamma=gamma)
     c = dict(zip(g.nodes(), list(map(int, lmodule[0]))))
     networkx.set_node_attributes(g, name='louvain', values=c)
     return c
+
+def _precompute_algargs(g, alg, algargs={}):
+    """Add arguments for `alg` which can be reused across runs on `g`.
+
+    Some community detection algorithms can take precomputed
+    information about the graph, which is expensive to find but
+    doesn't depend on the algorithm's parameters (e.g. gamma).  This
+    returns a copy of `algargs` with such arguments added (unless they
+    are already there), so that they only need to be found once when
+    `alg` is run many times on the same graph.
+    """
+    algargs = dict(algargs)
+    if alg is find_communities_louvain and "adj" not in algargs:
+        algargs["adj"] = networkx.to_numpy_array(g)
+    if alg is find_communities_leiden and "iggraph" not in algargs:
+        algargs["iggraph"] = _igraph_graph(g)
+    if alg is find_communities_louvain_gpu and "gpuedges" not in algargs:
+        algargs["gpuedges"] = _cugraph_edges(g)
+    return algargs
+
+def find_communities_leiden(g, gamma=1, iggraph=None):
+    """The leiden algorithm for community (module) structure.
+
+    This is a drop-in alternative to `find_communities_louvain` which
+    uses the leidenalg package (and its dependency python-igraph)
+    instead of bctpy.  The graph is passed to leidenalg as an edge
+    list, so no dense adjacency matrix is built, and the leiden
+    algorithm guarantees well-connected communities.  `gamma` is the
+    resolution parameter.  This function adds the "leiden" property to
+    each of the nodes, and returns a dictionary of community indices
+    indexed by node.
+
+    Optionally, `iggraph` may be `g` as an igraph graph, as returned by
+    `_igraph_graph`.  This saves converting the graph each time the
+    algorithm is run.  (consensus_matrix does this automatically.)
+    """
+    import leidenalg
+    assert type(g) == networkx.classes.graph.Graph, "Not a graph"
+    if iggraph is None:
+        iggraph = _igraph_graph(g)
+    # leidenalg is deterministic unless given a seed, so draw a new one
+    # each time to get a different partition on each run.
+    part = leidenalg.find_partition(iggraph, leidenalg.RBConfigurationVertexPartition,
+                                    weights="weight", resolution_parameter=gamma,
+                                    seed=numpy.random.randint(2**31))
+    c = dict(zip(g.nodes(), part.membership))
+    networkx.set_node_attributes(g, name='leiden', values=c)
+    return c
+
+def _igraph_graph(g):
+    """Convert the networkx graph `g` to an igraph graph.
+
+    Vertices are numbered by their position in g.nodes(), and edge
+    weights are stored in the "weight" edge attribute.
+    """
+    import igraph
+    nodeindex = {n : i for i,n in enumerate(g.nodes())}
+    edges = [(nodeindex[u], nodeindex[v]) for u,v in g.edges()]
+    weights = [w for _,_,w in g.edges(data="weight", default=1)]
+    return igraph.Graph(n=len(nodeindex), edges=edges, edge_attrs={"weight" : weights})
+
+def find_communities_louvain_gpu(g, gamma=1, gpuedges=None):
+    """The louvain algorithm for community (module) structure, on a GPU.
+
+    This is an alternative to `find_communities_louvain` which uses
+    the cugraph package (part of RAPIDS) to run the louvain algorithm
+    on an NVIDIA GPU.  `gamma` is the resolution parameter.  This
+    function adds the "louvain_gpu" property to each of the nodes, and
+    returns a dictionary of community indices indexed by node.
+
+    Optionally, `gpuedges` may be the edge list of `g`, as returned by
+    `_cugraph_edges`.  This saves rebuilding it each time the
+    algorithm is run.  (consensus_matrix does this automatically.)
+    """
+    import cudf, cugraph
+    assert type(g) == networkx.classes.graph.Graph, "Not a graph"
+    if gpuedges is None:
+        gpuedges = _cugraph_edges(g)
+    src,dst,weight = gpuedges
+    # cugraph.louvain takes no seed, and gives the same partition each
+    # time it is run on the same graph.  So, number the vertices in a
+    # random order on each run to get a different partition each time.
+    perm = numpy.random.permutation(len(g))
+    edges = cudf.DataFrame({"src" : perm[src], "dst" : perm[dst], "weight" : weight})
+    gpugraph = cugraph.Graph()
+    gpugraph.from_cudf_edgelist(edges, source="src", destination="dst", edge_attr="weight", renumber=False)
+    parts,_ = cugraph.louvain(gpugraph, resolution=gamma)
+    parts = parts.to_pandas()
+    membership = dict(zip(parts["vertex"], parts["partition"]))
+    # Nodes without any edges are not part of the cugraph graph, so
+    # give each of them a community of its own.
+    c = {n : int(membership[perm[i]]) if perm[i] in membership else -1-i for i,n in enumerate(g.nodes())}
+    networkx.set_node_attributes(g, name='louvain_gpu', values=c)
+    return c
+
+def _cugraph_edges(g):
+    """The edge list of the networkx graph `g`, for cugraph.
+
+    This returns a tuple of numpy arrays of source vertices,
+    destination vertices, and edge weights, where vertices are
+    numbered by their position in g.nodes().
+    """
+    nodeindex = {n : i for i,n in enumerate(g.nodes())}
+    src = numpy.asarray([nodeindex[u] for u,_ in g.edges()], dtype=int)
+    dst = numpy.asarray([nodeindex[v] for _,v in g.edges()], dtype=int)
+    weight = numpy.asarray([w for _,_,w in g.edges(data="weight", default=1)], dtype=float)
+    return (src, dst, weight)